@@ -1,12 +1,41 @@
 from fastapi import FastAPI, Request
 from pydantic import BaseModel
-from indexer import ensure_index, retrieve_context
+from indexer import ensure_index, retrieve_context, iter_files
 from llm import ask_llm
 from fastapi.middleware.cors import CORSMiddleware
 from probing import construct_retrieval_query
+from batcher import QueryBatcher
 import os
+import time
+import asyncio
 import logging
+import threading
+from functools import lru_cache
 app = FastAPI()
+query_batcher = QueryBatcher()
+
+CANDIDATE_TAIL_BYTES = 64 * 1024  # only the end of the candidate file is probed
+INDEX_TTL = float(os.environ.get("INDEX_TTL", "30"))  # seconds between implicit re-index scans in /chat
+_LAST_INDEX: dict[str, float] = {}
+# storage/ (docs.arrow, emb.mmap, BM25 store) is shared by every root, so all scans take one lock
+_INDEX_LOCK = threading.Lock()
+
+
+def ensure_index_fresh(root: str, force: bool = False):
+    """Run ensure_index if forced or if root was last scanned more than INDEX_TTL seconds ago.
+
+    Scans are serialized; requests that waited on a running scan re-check the
+    per-root TTL and reuse its result instead of starting another one.
+    """
+    requested = time.monotonic()
+    with _INDEX_LOCK:
+        last = _LAST_INDEX.get(root, float("-inf"))
+        if force and last >= requested:
+            return  # a scan that started after this request already finished
+        if force or time.monotonic() - last > INDEX_TTL:
+            started = time.monotonic()
+            ensure_index(root)
+            _LAST_INDEX[root] = started
 
 app.add_middleware(
     CORSMiddleware,
@@ -21,43 +50,58 @@ class IndexRequest(BaseModel):
     parent_root: str
 @app.post("/index")
 async def index_folder(req: IndexRequest):
-    ensure_index(req.parent_root)
+    await asyncio.to_thread(ensure_index_fresh, req.parent_root, force=True)
     return {"status": "ok"}
 @app.post("/chat")
-def chat(req: ChatRequest):
-    ensure_index(req.parent_root)
+async def chat(req: ChatRequest):
+    # Blocking stages run in worker threads so the event loop keeps accepting requests
+    await asyncio.to_thread(ensure_index_fresh, req.parent_root)
 
     # Find a code file to probe (simplify: pick currently edited or last modified file)
-    candidate_file = find_recent_code_file(req.parent_root)
+    candidate_file = await asyncio.to_thread(find_recent_code_file, req.parent_root)
     if candidate_file:
         logging.info(f"📄 Candidate file opened: {candidate_file}")
-        with open(candidate_file, "r", encoding="utf-8") as f:
-            code_text = f.read()
-        retrieval_query = construct_retrieval_query(req.question, code_text)
+        code_text = await asyncio.to_thread(read_candidate_file, candidate_file)
+        retrieval_query = await asyncio.to_thread(construct_retrieval_query, req.question, code_text)
         logging.info(f"Query: {retrieval_query}")
     else:
         logging.info("⚠️ No candidate file found.")
         retrieval_query = req.question
 
     # 🔸 Use the constructed retrieval query for context retrieval
-    retrieved = retrieve_context(req.parent_root, retrieval_query, top_k=8)
+    query_emb = await query_batcher.encode_async(retrieval_query)
+    retrieved = await asyncio.to_thread(retrieve_context, req.parent_root, retrieval_query, top_k=8, query_emb=query_emb)
     logging.info(f"Documents retrieved: {retrieved}")
     # Ask the LLM with the *user question* + retrieved context
-    answer = ask_llm(req.question, retrieved)
+    answer = await asyncio.to_thread(ask_llm, req.question, retrieved)
     return {"answer": answer, "context": retrieved}
 
 
+def read_candidate_file(path: str):
+    """Return the last CANDIDATE_TAIL_BYTES of path, cached while its mtime and size are unchanged."""
+    st = os.stat(path)
+    return _read_tail(path, st.st_mtime, st.st_size)
+
+
+@lru_cache(maxsize=8)
+def _read_tail(path: str, mtime: float, size: int):
+    with open(path, "rb") as f:
+        f.seek(max(0, size - CANDIDATE_TAIL_BYTES))
+        data = f.read(CANDIDATE_TAIL_BYTES)
+    if size > CANDIDATE_TAIL_BYTES and b"\n" in data:
+        # drop the partial first line left by seeking into the middle of the file
+        data = data.partition(b"\n")[2]
+    return data.decode("utf-8", "ignore")
+
+
 def find_recent_code_file(root_dir: str):
     """Pick the most recently modified code file in the workspace."""
-    exts = (".py", ".js", ".ts", ".cpp", ".java", ".cs", ".ipynb")
+    exts = {".py", ".js", ".ts", ".cpp", ".java", ".cs", ".ipynb"}
     latest = None
     latest_mtime = -1
-    for dirpath, _, filenames in os.walk(root_dir):
-        for f in filenames:
-            if f.endswith(exts):
-                fp = os.path.join(dirpath, f)
-                mtime = os.path.getmtime(fp)
-                if mtime > latest_mtime:
-                    latest = fp
-                    latest_mtime = mtime
+    for entry in iter_files(root_dir, exts):
+        mtime = entry.stat().st_mtime
+        if mtime > latest_mtime:
+            latest = entry.path
+            latest_mtime = mtime
     return latest
@@ -0,0 +1,76 @@
+# batcher.py
+import os
+import time
+import asyncio
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+from indexer import encode_texts
+
+QUERY_BATCH = int(os.environ.get("QUERY_BATCH", "16"))  # max queries per encoder forward
+QUERY_BATCH_WAIT_MS = float(os.environ.get("QUERY_BATCH_WAIT_MS", "10"))  # coalescing window
+
+
+class QueryBatcher:
+    """Coalesces concurrent single-query encodes into one encode_texts call.
+
+    Callers block on encode() or await encode_async(); a background thread drains up to max_batch queued
+    queries (waiting at most max_wait_ms after the first one) and runs one forward.
+    """
+
+    def __init__(self, max_batch=QUERY_BATCH, max_wait_ms=QUERY_BATCH_WAIT_MS):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="query-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, text) -> Future:
+        fut = Future()
+        self._queue.put((text, fut))
+        return fut
+
+    def encode(self, text):
+        """Return the (1, dim) CUDA embedding for text."""
+        return self.submit(text).result()
+
+    async def encode_async(self, text):
+        """Awaitable encode() for async endpoints; does not block the event loop."""
+        return await asyncio.wrap_future(self.submit(text))
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(items) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # Callers may have been cancelled while queued (wrap_future propagates cancellation)
+            items = [(text, fut) for text, fut in items if fut.set_running_or_notify_cancel()]
+            if not items:
+                continue
+
+            try:
+                emb = encode_texts([text for text, _ in items], batch_size=len(items), return_tensor=True)
+            except Exception as e:
+                logging.exception("Query batch encoding failed")
+                results = [(fut, None, e) for _, fut in items]
+            else:
+                results = [(fut, emb[i:i + 1], None) for i, (_, fut) in enumerate(items)]
+
+            for fut, value, exc in results:
+                try:
+                    if exc is not None:
+                        fut.set_exception(exc)
+                    else:
+                        fut.set_result(value)
+                except Exception:
+                    # never let one bad future take down the only batcher thread
+                    logging.exception("Could not deliver query embedding")
@@ -1,22 +1,34 @@
 import os
-import json
-import hashlib
+import orjson
 import time
 import logging
+import shutil
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import threading
 import numpy as np
+import pyarrow as pa
 import faiss
+import faiss.contrib.torch_utils  # lets index.search take torch tensors (incl. CUDA) directly
 import ast
 import torch
 from transformers import AutoTokenizer, AutoModel
-from rank_bm25 import BM25Okapi
+import bm25s
 import re
+from blake3 import blake3
 # ================================
 # Configuration
 # ================================
 INDEX_DIR = "storage"
+SKIP_DIRS = {".git", "__pycache__", "node_modules"}
 TEXT_EXTENSIONS = {".py", ".js", ".ts", ".java", ".cpp", ".cs", ".txt", ".md", ".ipynb", ".toml", ".yaml"}
 MODEL_NAME = "jinaai/jina-embeddings-v2-base-code"  # Code-aware embedding model
+HNSW_MIN_VECTORS = 2000  # below this an exhaustive flat scan is cheap enough
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+EMB_BATCH = int(os.environ.get("EMB_BATCH", "64"))  # starting batch size, halved on CUDA OOM
+EMPTY_CACHE_EVERY = 32  # batches between torch.cuda.empty_cache() calls in encode_texts
 
 # Load Jina model properly (no partial weights issue)
 tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
@@ -24,52 +36,204 @@ model = AutoModel.from_pretrained(MODEL_NAME, trust_remote_code=True).to("cuda")
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+faiss.omp_set_num_threads(os.cpu_count() or 1)
+
+BM25_POINTER = f"{INDEX_DIR}/bm25.current"  # names the live bm25-<ns> store directory
+DOCS_PATH = f"{INDEX_DIR}/docs.arrow"
+DOCS_SCHEMA = pa.schema(
+    [(name, pa.string()) for name in ("uid", "path", "name", "type", "text", "hash")]
+    + [("mtime", pa.float64()), ("size", pa.int64())]  # source file stat, used to skip unchanged files
+)
+
+# Per-root retrieval state: {index, on_gpu, docs, bm25, bm25_dir, mtime}; dropped by ensure_index on rebuild
+_CACHE: dict[str, dict] = {}
+_GPU_RES = None  # shared faiss.StandardGpuResources, created on first GPU index
+_GPU_LOCK = threading.Lock()  # FAISS GPU resources/indexes are not thread-safe
+_emb_batch = EMB_BATCH  # largest batch size known to fit, lowered after an OOM
+
 # ================================
 # Utilities
 # ================================
 def hash_text(text: str):
-    """SHA256 hash for incremental change detection."""
-    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+    """BLAKE3 hash for incremental change detection."""
+    return blake3(text.encode("utf-8")).hexdigest()
 
 
 def load_json(path, default=None):
     if os.path.exists(path):
-        with open(path, "r") as f:
-            return json.load(f)
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
     return default if default is not None else []
 
 
 def save_json(obj, path):
-    with open(path, "w") as f:
-        json.dump(obj, f, indent=2)
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(obj))
+
+def index_to_gpu(index, emb_store):
+    """Serve a flat index from GPU 0 when faiss-gpu is available; returns (index, on_gpu).
+
+    The on-disk int8 ScalarQuantizer index has no GPU clone, so the GPU copy is an
+    fp16 IndexFlatIP built from the fp32 embeddings in emb_store.
+    """
+    global _GPU_RES
+    if not hasattr(faiss, "StandardGpuResources") or faiss.get_num_gpus() == 0:
+        return index, False
+    if isinstance(index, faiss.IndexHNSW):  # no GPU implementation
+        return index, False
+    try:
+        flat = faiss.IndexFlatIP(emb_store.dim)
+        flat.add(emb_store.load())
+        co = faiss.GpuClonerOptions()
+        co.useFloat16 = True
+        with _GPU_LOCK:
+            if _GPU_RES is None:
+                _GPU_RES = faiss.StandardGpuResources()
+            return faiss.index_cpu_to_gpu(_GPU_RES, 0, flat, co), True
+    except Exception as e:  # any failure building the GPU copy falls back to the CPU index
+        logging.warning(f"FAISS index kept on CPU: {e}")
+        return index, False
+
+
+def save_docs(docs, path=DOCS_PATH):
+    """Write chunk metadata as an Arrow IPC file (atomically, so live memory maps stay valid)."""
+    table = pa.Table.from_pylist(docs, schema=DOCS_SCHEMA)
+    tmp_path = f"{path}.tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, DOCS_SCHEMA) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+def load_docs(path=DOCS_PATH):
+    """Memory-map the chunk metadata table; returns None if it has not been written yet."""
+    if not os.path.exists(path):
+        return None
+    return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+
+class EmbStore:
+    """Append-only float32 embedding matrix in a raw memmap file with doubling capacity.
+
+    emb.mmap holds `capacity` rows; emb.meta.json records n, capacity and dim.
+    """
+
+    def __init__(self, directory=INDEX_DIR, name="emb"):
+        self.data_path = f"{directory}/{name}.mmap"
+        self.meta_path = f"{directory}/{name}.meta.json"
+        meta = load_json(self.meta_path, {})
+        self.n = meta.get("n", 0)
+        self.capacity = meta.get("capacity", 0)
+        self.dim = meta.get("dim")
+
+    def exists(self):
+        return self.n > 0 and os.path.exists(self.data_path)
+
+    def clear(self):
+        for p in (self.data_path, self.meta_path):
+            if os.path.exists(p):
+                os.remove(p)
+        self.n, self.capacity, self.dim = 0, 0, None
+
+    def append(self, emb):
+        emb = np.ascontiguousarray(emb, dtype="float32")
+        if self.dim is None:
+            self.dim = emb.shape[1]
+        needed = self.n + len(emb)
+        if needed > self.capacity or not os.path.exists(self.data_path):
+            self.capacity = max(2 * self.capacity, needed)
+            with open(self.data_path, "ab") as f:
+                f.truncate(self.capacity * self.dim * 4)  # grows sparsely, existing rows untouched
+        mm = np.memmap(self.data_path, dtype="float32", mode="r+", shape=(self.capacity, self.dim))
+        mm[self.n:needed] = emb
+        mm.flush()
+        del mm
+        self.n = needed
+        save_json({"n": self.n, "capacity": self.capacity, "dim": self.dim}, self.meta_path)
+
+    def load(self):
+        """Read-only (n, dim) view of the stored embeddings.
+
+        Returned as a plain ndarray (still file-backed): faiss.contrib.torch_utils only
+        accepts exact np.ndarray or torch.Tensor, not np.memmap.
+        """
+        return np.asarray(np.memmap(self.data_path, dtype="float32", mode="r", shape=(self.n, self.dim)))
+
+
+_TOKEN_RE = re.compile(r"[A-Za-z0-9_]+", re.ASCII)
+
 
 def tokenize_code(text):
-    return re.findall(r"\w+", text)
+    return _TOKEN_RE.findall(text)
 # ================================
 # Embedding Function
 # ================================
-def encode_texts(texts, batch_size=16):
-    """Encode texts using Jina embedding model."""
+def encode_texts(texts, batch_size=None, return_tensor=False):
+    """Encode texts using Jina embedding model.
+
+    Texts are sorted by token length before batching so each batch pads only
+    to its own longest member; outputs are returned in the original order.
+    batch_size defaults to EMB_BATCH and is halved on CUDA OOM.
+    With return_tensor=True the embeddings stay on the GPU as a torch tensor.
+    """
+    global _emb_batch
+    probing = batch_size is None
+    if probing:
+        batch_size = _emb_batch
     all_embeddings = []
 
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i:i + batch_size]
-        inputs = tokenizer(batch, padding=True, truncation=True, return_tensors="pt").to("cuda")
-
-        with torch.no_grad():
-            outputs = model(**inputs)
-            # Jina models output pooled embeddings directly
-            if hasattr(outputs, "pooler_output"):
-                emb = outputs.pooler_output
-            elif isinstance(outputs, torch.Tensor):
-                emb = outputs
-            else:
-                emb = outputs[0]
-
-            emb = torch.nn.functional.normalize(emb, p=2, dim=1)
-            all_embeddings.append(emb.cpu().numpy().astype("float32"))
+    # Tokenize once; the same encodings give the sort key and are padded per batch
+    encoded = tokenizer(list(texts), truncation=True)
+    order = np.argsort([len(ids) for ids in encoded["input_ids"]], kind="stable")
+    features = [{k: encoded[k][j] for k in encoded.keys()} for j in order]
+
+    i = n_batches = 0
+    while i < len(features):
+        batch = features[i:i + batch_size]
+        inputs = tokenizer.pad(batch, padding="longest", return_tensors="pt").to("cuda")
+
+        try:
+            with torch.inference_mode(), torch.autocast("cuda", dtype=torch.float16):
+                outputs = model(**inputs)
+                # Jina models output pooled embeddings directly
+                if hasattr(outputs, "pooler_output"):
+                    emb = outputs.pooler_output
+                elif isinstance(outputs, torch.Tensor):
+                    emb = outputs
+                else:
+                    emb = outputs[0]
+
+                emb = torch.nn.functional.normalize(emb.float(), p=2, dim=1)
+        except torch.cuda.OutOfMemoryError:
+            if batch_size == 1:
+                raise
+            batch_size //= 2
+            if probing:
+                _emb_batch = batch_size
+            del inputs
+            torch.cuda.empty_cache()
+            logging.warning(f"CUDA OOM while embedding, retrying with batch_size={batch_size}")
+            continue
 
-    return np.vstack(all_embeddings)
+        if return_tensor:
+            all_embeddings.append(emb)
+        else:
+            # Async copy into pinned host memory; synchronized once after the loop
+            host = torch.empty(emb.shape, dtype=emb.dtype, pin_memory=True)
+            host.copy_(emb, non_blocking=True)
+            all_embeddings.append(host)
+        del inputs, outputs, emb
+        i += len(batch)
+        n_batches += 1
+        if n_batches % EMPTY_CACHE_EVERY == 0:
+            torch.cuda.empty_cache()
+
+    inverse = np.argsort(order)
+    if return_tensor:
+        out = torch.cat(all_embeddings)
+        return out[torch.as_tensor(inverse, device=out.device)]
+    torch.cuda.synchronize()
+    return torch.cat(all_embeddings).numpy()[inverse]
 
 
 # ================================
@@ -108,45 +272,93 @@ def extract_code_chunks(path):
 # ================================
 # Indexing
 # ================================
+def iter_files(root_dir, exts=TEXT_EXTENSIONS):
+    """Yield os.DirEntry objects for files under root_dir whose lowercased suffix is in exts, skipping SKIP_DIRS."""
+    try:
+        with os.scandir(root_dir) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in SKIP_DIRS:
+                        yield from iter_files(entry.path, exts)
+                elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in exts:
+                    yield entry
+    except OSError:
+        return
+
+
+def _process_file(p, known_stats):
+    """Read, chunk and hash one file; runs in the scan thread pool.
+
+    Returns (path, stat, docs) with docs=None, without parsing, when the file's
+    (mtime, size) matches known_stats.
+    """
+    path = str(p.resolve())
+    st = p.stat()
+    stat = (st.st_mtime, st.st_size)
+    if known_stats.get(path) == stat:
+        return path, stat, None
+
+    docs = []
+    for c in extract_code_chunks(p):
+        snippet = c["code"].strip()[:3000]
+        if not snippet:
+            continue
+        docs.append({
+            "uid": f"{path}::{c['name']}",
+            "path": path,
+            "name": c["name"],
+            "type": c["type"],
+            "text": snippet,
+            "hash": hash_text(snippet),
+            "mtime": st.st_mtime,
+            "size": st.st_size
+        })
+    return path, stat, docs
+
+
 def ensure_index(root_dir: str):
     os.makedirs(INDEX_DIR, exist_ok=True)
     index_path = f"{INDEX_DIR}/{Path(root_dir).stem}.faiss"
-    docs_json_path = f"{INDEX_DIR}/docs.json"
-    emb_cache_path = f"{INDEX_DIR}/embeddings.npy"
+    emb_store = EmbStore()
+
+    existing_docs = load_docs()
+    existing_docs_dict = {d["uid"]: d for d in existing_docs.to_pylist()} if existing_docs is not None else {}
 
-    existing_docs = load_json(docs_json_path, [])
-    existing_docs_dict = {d["uid"]: d for d in existing_docs}
+    docs_by_path = {}
+    for d in existing_docs_dict.values():
+        docs_by_path.setdefault(d["path"], []).append(d)
+    # A file's stored docs always share one stat (it is refreshed on all of them below)
+    known_stats = {path: (ds[0].get("mtime"), ds[0].get("size")) for path, ds in docs_by_path.items()}
 
     new_docs = []
+    stats_changed = False
 
     logging.info(f"📦 Scanning directory: {root_dir}")
-    for p in Path(root_dir).rglob("*.*"):
-        if not (p.is_file() and p.suffix.lower() in TEXT_EXTENSIONS):
-            continue
-        if any(x in str(p) for x in [".git", "__pycache__"]):
-            continue
+    paths = [Path(entry.path) for entry in iter_files(root_dir)]
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as ex:
+        results = list(ex.map(partial(_process_file, known_stats=known_stats), paths))
 
-        chunks = extract_code_chunks(p)
-        for c in chunks:
-            snippet = c["code"].strip()
-            if not snippet:
-                continue
-            snippet_hash = hash_text(snippet[:3000])
-            uid = f"{p.resolve()}::{c['name']}"
-            old_hash = existing_docs_dict.get(uid, {}).get("hash")
-
-            if old_hash != snippet_hash:
-                new_docs.append({
-                    "uid": uid,
-                    "path": str(p.resolve()),
-                    "name": c["name"],
-                    "type": c["type"],
-                    "text": snippet[:3000],
-                    "hash": snippet_hash
-                })
-                logging.info(f"   ➕ Updated: {uid}")
+    for path, (mtime, size), file_docs in results:
+        if file_docs is None:
+            continue
+        # Record the new stat on every stored doc for this file, including chunks that
+        # no longer exist in it, so the file is skipped next time if it stays unchanged
+        for old in docs_by_path.get(path, []):
+            if (old.get("mtime"), old.get("size")) != (mtime, size):
+                old["mtime"], old["size"] = mtime, size
+                stats_changed = True
+        for d in file_docs:
+            old = existing_docs_dict.get(d["uid"])
+            if old is None or old["hash"] != d["hash"]:
+                new_docs.append(d)
+                logging.info(f"   ➕ Updated: {d['uid']}")
 
     if not new_docs:
+        if stats_changed:
+            save_docs(list(existing_docs_dict.values()))
+        if existing_docs_dict and current_bm25_dir() is None:
+            build_bm25(list(existing_docs_dict.values()))  # e.g. store from before the pointer file
+            _CACHE.pop(root_dir, None)
         logging.info("✅ No new or updated code chunks found.")
         return
 
@@ -154,7 +366,7 @@ def ensure_index(root_dir: str):
     for d in new_docs:
         existing_docs_dict[d["uid"]] = d
     all_docs = list(existing_docs_dict.values())
-    save_json(all_docs, docs_json_path)
+    save_docs(all_docs)
 
     # Embed new docs only
     texts = [d["text"] for d in new_docs]
@@ -163,62 +375,173 @@ def ensure_index(root_dir: str):
     logging.info(f"🧠 Embedded {len(texts)} new chunks in {time.time() - t0:.2f}s")
 
     # Update FAISS index
-    if os.path.exists(index_path) and os.path.exists(emb_cache_path):
+    if os.path.exists(index_path) and emb_store.exists():
         index = faiss.read_index(index_path)
-        old_emb = np.load(emb_cache_path)
-        all_emb = np.concatenate([old_emb, new_emb], axis=0)
     else:
-        index = faiss.IndexFlatIP(new_emb.shape[1])
-        all_emb = new_emb
-
-    index.add(new_emb)
-    np.save(emb_cache_path, all_emb)
-    faiss.write_index(index, index_path)
+        index = None
+        emb_store.clear()
+    emb_store.append(new_emb)
+    all_emb = emb_store.load()
+
+    # Small flat indexes are rebuilt (and the quantizer retrained) on every update;
+    # an HNSW index is built once past HNSW_MIN_VECTORS and appended to afterwards
+    if isinstance(index, faiss.IndexHNSW):
+        index.add(new_emb)
+    else:
+        index = build_faiss_index(all_emb)
+    tmp_index_path = f"{index_path}.tmp"
+    faiss.write_index(index, tmp_index_path)
+    os.replace(tmp_index_path, index_path)  # readers never see a truncated index
     logging.info(f"✅ FAISS index updated ({len(all_emb)} vectors).")
 
-    # Build BM25
-    tokenized = [d["text"].split() for d in all_docs]
+    build_bm25(all_docs)
+    _CACHE.pop(root_dir, None)
+
+
+def build_bm25(all_docs):
+    """Build BM25 over all_docs (scores are precomputed into a sparse matrix by bm25s) and save it."""
     tokenized = [tokenize_code(d["text"]) for d in all_docs]
-    bm25 = BM25Okapi(tokenized)
-    save_json({"docs": all_docs}, f"{INDEX_DIR}/bm25.json")
+    retriever = bm25s.BM25()
+    retriever.index(tokenized, show_progress=False)
+    save_bm25(retriever)
     logging.info("✅ BM25 index refreshed.")
 
 
-# ================================
-# Retrieval (Hybrid)
-# ================================
-def retrieve_context(root_dir, query, top_k=8, alpha=0.7):
-    """Hybrid dense + lexical retrieval"""
-    docs = load_json(f"{INDEX_DIR}/docs.json")
-    if not docs:
+def build_faiss_index(emb):
+    """Int8 scalar-quantized inner-product index over emb: flat for small corpora, HNSW above HNSW_MIN_VECTORS."""
+    emb = np.asarray(emb, dtype="float32")  # torch_utils-patched train/add reject ndarray subclasses
+    n, dim = emb.shape
+    if n < HNSW_MIN_VECTORS:
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    else:
+        index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    index.train(emb)
+    index.add(emb)
+    return index
+
+
+def current_bm25_dir():
+    """Directory of the live BM25 store, or None if none has been saved."""
+    if not os.path.exists(BM25_POINTER):
+        return None
+    with open(BM25_POINTER) as f:
+        return f"{INDEX_DIR}/{f.read().strip()}"
+
+
+def save_bm25(retriever):
+    """Save into a fresh bm25-<ns> directory, then atomically repoint BM25_POINTER at it.
+
+    bm25s writes several files; saving in place would let a concurrent load mix builds.
+    The previous store is kept for readers that resolved the pointer just before the swap.
+    """
+    previous = current_bm25_dir()
+    name = f"bm25-{time.time_ns()}"
+    retriever.save(f"{INDEX_DIR}/{name}")
+    tmp_pointer = f"{BM25_POINTER}.tmp"
+    with open(tmp_pointer, "w") as f:
+        f.write(name)
+    os.replace(tmp_pointer, BM25_POINTER)
+
+    keep = {name, os.path.basename(previous) if previous else None}
+    with os.scandir(INDEX_DIR) as it:
+        stale = [e.path for e in it if e.is_dir() and e.name.startswith("bm25-") and e.name not in keep]
+    for path in stale:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def load_retrieval_state(root_dir):
+    """Return cached FAISS index, docs and BM25 for root_dir.
+
+    Everything is reloaded when the FAISS index file changes; BM25 alone when only its store is swapped.
+    """
+    index_path = f"{INDEX_DIR}/{Path(root_dir).stem}.faiss"
+    if not os.path.exists(index_path) or not EmbStore().exists():
+        raise ValueError("Missing FAISS or embedding cache.")
+
+    bm25_dir = current_bm25_dir()
+    if bm25_dir is None:
+        raise ValueError("Missing BM25 index. Run ensure_index() first.")
+
+    mtime = os.path.getmtime(index_path)
+    state = _CACHE.get(root_dir)
+    if state is not None and state["mtime"] == mtime:
+        if state["bm25_dir"] != bm25_dir:
+            # BM25 rebuilt elsewhere (e.g. another worker) without touching the FAISS index
+            state["bm25"] = bm25s.BM25.load(bm25_dir)
+            state["bm25_dir"] = bm25_dir
+            logging.info("📂 Reloaded BM25 index.")
+        return state
+
+    docs = load_docs()
+    if docs is None or docs.num_rows == 0:
         raise ValueError("No indexed documents found. Run ensure_index() first.")
 
-    index_path = f"{INDEX_DIR}/{Path(root_dir).stem}.faiss"
-    emb_cache_path = f"{INDEX_DIR}/embeddings.npy"
+    index, on_gpu = index_to_gpu(faiss.read_index(index_path), EmbStore())
+    state = {
+        "index": index,
+        "on_gpu": on_gpu,
+        "docs": docs,
+        "bm25": bm25s.BM25.load(bm25_dir),
+        "bm25_dir": bm25_dir,
+        "mtime": mtime,
+    }
+    _CACHE[root_dir] = state
+    logging.info(f"📂 Loaded retrieval state for {root_dir} ({len(docs)} docs).")
+    return state
 
-    if not os.path.exists(index_path) or not os.path.exists(emb_cache_path):
-        raise ValueError("Missing FAISS or embedding cache.")
 
-    # Dense
-    emb = encode_texts([query])
-    index = faiss.read_index(index_path)
-    dense_scores, dense_idx = index.search(emb, top_k * 2)
+# ================================
+# Retrieval (Hybrid)
+# ================================
+def retrieve_context(root_dir, query, top_k=8, alpha=0.7, query_emb=None):
+    """Hybrid dense + lexical retrieval
+
+    query_emb, if given, is the precomputed (1, dim) embedding of query (e.g. from QueryBatcher).
+    """
+    state = load_retrieval_state(root_dir)
+    docs = state["docs"]
+
+    # Dense (query embedding stays on CUDA when the index lives there)
+    emb = query_emb if query_emb is not None else encode_texts([query], return_tensor=True)
+    if not state["on_gpu"]:
+        emb = emb.cpu()
+    index = state["index"]
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = max(top_k * 4, 64)
+    if state["on_gpu"]:
+        with _GPU_LOCK:
+            dense_scores, dense_idx = index.search(emb, top_k * 2)
+    else:
+        dense_scores, dense_idx = index.search(emb, top_k * 2)
+    dense_scores, dense_idx = dense_scores.cpu().numpy(), dense_idx.cpu().numpy()
 
     # Lexical (BM25)
-    bm25_data = load_json(f"{INDEX_DIR}/bm25.json")
-    tokenized = [d["text"].split() for d in bm25_data["docs"]]
-    bm25 = BM25Okapi(tokenized)
-    query_tokens = query.replace("\n", " ").split()  # simple, same as indexing
-    bm25_scores = bm25.get_scores(query_tokens)
+    bm25 = state["bm25"]
+    query_tokens = tokenize_code(query)  # same tokenizer as indexing
+    if query_tokens:
+        bm25_scores = bm25.get_scores(query_tokens)
+    else:
+        bm25_scores = np.zeros(len(docs), dtype="float32")
+    if len(bm25_scores) != len(docs):
+        # Caught mid-rebuild (docs written, BM25 not yet): score dense-only and reload next time
+        logging.warning(f"BM25 covers {len(bm25_scores)} docs but {len(docs)} are indexed; skipping lexical scores.")
+        _CACHE.pop(root_dir, None)
+        bm25_scores = np.zeros(len(docs), dtype="float32")
     logging.info(f"Dense scores: {dense_scores[0][:10]}")
     logging.info(f"Dense idx: {dense_idx[0][:10]}")
-    logging.info(f"BM25 max: {bm25_scores.max()} | BM25 nonzero: {(bm25_scores > 0).sum()}")
-    # Fusion
-    combined = {}
-    for i, doc_idx in enumerate(dense_idx[0]):
-        if doc_idx < len(docs):
-            max_bm25 = bm25_scores.max() if bm25_scores.max() > 0 else 1.0
-            combined[doc_idx] = alpha * dense_scores[0][i] + (1 - alpha) * (bm25_scores[doc_idx] / max_bm25)
-
-    top_results = sorted(combined.items(), key=lambda x: x[1], reverse=True)[:top_k]
-    return [docs[i]["text"][:1000] for i, _ in top_results]
+    max_bm25 = float(bm25_scores.max()) if len(bm25_scores) else 0.0
+    logging.info(f"BM25 max: {max_bm25} | BM25 nonzero: {(bm25_scores > 0).sum()}")
+    # Fusion (vectorized over the dense candidates; FAISS pads missing hits with -1)
+    idx = dense_idx[0]
+    mask = (idx >= 0) & (idx < len(docs))
+    idx = idx[mask]
+    if len(idx) == 0:
+        return []
+    fused = alpha * dense_scores[0][mask] + (1 - alpha) * (bm25_scores[idx] / (max_bm25 if max_bm25 > 0 else 1.0))
+
+    k = min(top_k, len(fused))
+    top = np.argpartition(-fused, k - 1)[:k]
+    top = top[np.argsort(-fused[top], kind="stable")]
+    texts = docs.column("text")
+    return [texts[int(i)].as_py()[:1000] for i in idx[top]]
@@ -1,6 +1,7 @@
 # probing.py
 from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 import torch
+import torch.nn.functional as F
 
 # Load once at startup
 model_id = "Salesforce/codet5p-220m"
@@ -10,9 +11,12 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 model = AutoModelForSeq2SeqLM.from_pretrained(model_id).to(device)
 model.eval()
 
-def construct_retrieval_query(user_question: str, code_text: str, f: int = 10, m: int = 10, g: int = 10):
+def construct_retrieval_query(user_question: str, code_text: str, f: int = 10, m: int = 10, g: int = 10,
+                              batch_size: int = 32):
     """
     Build retrieval query via log-probability-guided probing (Algorithm 1)
+    Probes are scored batch_size at a time in a single forward pass each;
+    batch_size is halved on CUDA OOM.
     """
     lines = code_text.splitlines()
     chunks = ["\n".join(lines[i:i+f]) for i in range(0, len(lines), f)]
@@ -22,15 +26,29 @@ def construct_retrieval_query(user_question: str, code_text: str, f: int = 10, m
     # Treat the last chunk as target (simplification)
     target_chunk = chunks[-1]
 
+    probes = [ci + "\n" + target_chunk for ci in chunks[:-1]]
     scores = []
-    for i, ci in enumerate(chunks[:-1]):
-        probe = ci + "\n" + target_chunk
-        inputs = tokenizer(probe, return_tensors="pt", truncation=True, max_length=512).to(device)
-        with torch.no_grad():
-            outputs = model(**inputs, labels=inputs["input_ids"])
-            # loss is average negative log-likelihood per token, so multiply by length for total log-prob
-            log_probs = -outputs.loss.item() * inputs["input_ids"].size(1)
-        scores.append((i, log_probs))
+    start = 0
+    while start < len(probes):
+        batch = probes[start:start + batch_size]
+        inputs = tokenizer(batch, return_tensors="pt", padding=True, truncation=True, max_length=512).to(device)
+        # padded positions are ignored in the loss (and mapped back to pad by the decoder shift)
+        labels = inputs["input_ids"].masked_fill(inputs["attention_mask"] == 0, -100)
+        try:
+            with torch.inference_mode(), torch.autocast(device.type, dtype=torch.float16, enabled=device.type == "cuda"):
+                # no labels= here: the model's own mean loss would be discarded anyway
+                logits = model(**inputs, decoder_input_ids=model.prepare_decoder_input_ids_from_labels(labels=labels)).logits
+                # per-probe total negative log-likelihood (the old mean loss times token count)
+                nll = F.cross_entropy(logits.transpose(1, 2), labels, ignore_index=-100, reduction="none").sum(-1)
+        except torch.cuda.OutOfMemoryError:
+            if batch_size == 1:
+                raise
+            batch_size //= 2
+            del inputs, labels
+            torch.cuda.empty_cache()
+            continue
+        scores.extend((start + j, lp) for j, lp in enumerate((-nll.float()).tolist()))
+        start += len(batch)
 
     # Pick top-g chunks
     top_chunks = sorted(scores, key=lambda x: x[1], reverse=True)[:g]